@@ -6,36 +6,59 @@ from os.path import isfile, join
 import os
 import cv2
 import sqlite3
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import torch
 import easyocr
 import whisper
 from deep_translator import GoogleTranslator
 from logging.handlers import RotatingFileHandler
 logger = logging.getLogger(__name__)
-logging.basicConfig(handlers=[RotatingFileHandler('./logs/preprocess.log', encoding='utf-8', maxBytes=1000000, backupCount=5)], level=logging.DEBUG)
+# Worker processes log to their own files, rotating a shared log file from several processes is not safe
+if multiprocessing.current_process().name == 'MainProcess':
+    log_filename = './logs/preprocess.log'
+else:
+    log_filename = f'./logs/preprocess_{multiprocessing.current_process().name}.log'
+logging.basicConfig(handlers=[RotatingFileHandler(log_filename, encoding='utf-8', maxBytes=1000000, backupCount=5)], level=logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-# All EP2024 TikTok languages for OCR
-reader = easyocr.Reader(['en','fr','pl','sv','pt','de','es','hu','hr']) 
-# Load Whisper model
-model = whisper.load_model('large', download_root='./whisper/')
-
-# Sqlite3 database connection
-conn = sqlite3.connect('./database/preprocess.db')
-c = conn.cursor()
-# Create table if not exists
-c.execute('''CREATE TABLE IF NOT EXISTS tiktok_videos
-                (author_username text, 
-                video_id text,
-                frames text,
-                ocr_1 text,
-                ocr_2 text,
-                ocr_3 text,
-                ocr_4 text,
-                ocr_5 text,
-                ocr_6 text,
-                whisper_transcript text,
-                whisper_language text,
-                whisper_translated text)''')
-conn.commit()
+# Parallel preprocessing is configured from the Puhti batch job script.
+# With 0 OCR workers videos are preprocessed one at a time in this process.
+ocr_workers = int(os.environ.get('PREPROCESS_OCR_WORKERS', '0'))
+# Threads per OCR worker, keep ocr_workers * ocr_threads within the allocated cores
+ocr_threads = int(os.environ.get('PREPROCESS_OCR_THREADS', '1'))
+# Threads for the single Whisper worker
+whisper_threads = int(os.environ.get('PREPROCESS_WHISPER_THREADS', '8'))
+
+# EasyOCR reader and Whisper model are loaded on first use, once per process
+reader = None
+model = None
+
+def get_reader():
+    """Get the EasyOCR reader, loading it on first use."""
+    global reader
+    if reader is None:
+        # All EP2024 TikTok languages for OCR
+        reader = easyocr.Reader(['en','fr','pl','sv','pt','de','es','hu','hr'])
+    return reader
+
+def get_model():
+    """Get the Whisper model, loading it on first use."""
+    global model
+    if model is None:
+        model = whisper.load_model('large', download_root='./whisper/')
+    return model
+
+def set_thread_env(threads):
+    """Set OpenMP and BLAS thread limits inherited by the next started process."""
+    for variable in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[variable] = str(threads)
+
+def set_thread_limits(threads):
+    """Limit torch and OpenCV threads in the current process."""
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
 
 def save_keyframe(video_id, author_username, video_filename, frame_time, frame_number):
     """Extract and save a keyframe."""
@@ -79,8 +102,10 @@ def get_transcript(video_id, author_username, scrapedCountry):
     whisper_transcript = ''
     whisper_language = ''
     whisper_translated = ''
+    # A model that fails to load stops the run instead of saving empty transcripts
+    whisper_model = get_model()
     try:
-        result = model.transcribe(video_filename, temperature=[0.0, 0.2, 0.4, 0.6, 0.8, 1.0])
+        result = whisper_model.transcribe(video_filename, temperature=[0.0, 0.2, 0.4, 0.6, 0.8, 1.0])
         whisper_transcript = str(result['text'])
         whisper_language = result['language']
         whisper_translated = GoogleTranslator(source=whisper_language, target='en').translate(whisper_transcript[:3000])
@@ -89,9 +114,98 @@ def get_transcript(video_id, author_username, scrapedCountry):
         print(f'Error transcribing video {video_id}: {e}')
     return (whisper_transcript, whisper_language, whisper_translated)
 
+def get_ocr(frame_files):
+    """Get EasyOCR text for up to six keyframes."""
+    ocr_texts = ['', '', '', '', '', '']
+    for i, frame_file in enumerate(frame_files[:6]):
+        results = get_reader().readtext(frame_file)
+        ocr_text = ''
+        for result in results:
+            ocr_text = ocr_text + result[1]
+            ocr_text = ocr_text + '\n'
+        ocr_texts[i] = str(ocr_text)
+    return ocr_texts
 
-def analyze_videos(language):
-    """Preprocess TikTok videos for a specific language."""
+def init_ocr_worker(threads):
+    """Initialize an OCR worker process."""
+    set_thread_limits(threads)
+    # Load the reader before taking jobs, a load failure breaks the pool and stops the run
+    get_reader()
+
+def preprocess_frames(job):
+    """Extract keyframes and OCR text for one video in an OCR worker."""
+    (video_path, video_id, author_username) = job
+    frame_files = None
+    ocr_texts = None
+    try:
+        frame_files = get_keyframes(video_path, video_id, author_username)
+        ocr_texts = get_ocr(frame_files)
+    except Exception as e:
+        logger.error(f'Error processing video: {e}')
+        frame_files = None
+    return (str(author_username), str(video_id), frame_files, ocr_texts)
+
+def whisper_worker(audio_queue, result_queue, threads):
+    """Transcribe audio jobs from a queue in the single Whisper worker."""
+    set_thread_limits(threads)
+    # Load the model before taking jobs, a load failure ends the worker
+    get_model()
+    while True:
+        job = audio_queue.get()
+        # None tells the worker to stop
+        if job is None:
+            break
+        (video_id, author_username, scrapedCountry) = job
+        transcript = get_transcript(video_id, author_username, scrapedCountry)
+        result_queue.put((str(author_username), str(video_id), transcript))
+
+def load_processed(df, index, author_username, video_id):
+    """Load an already processed video from the database into the dataframe."""
+    c.execute("SELECT frames, ocr_1, ocr_2, ocr_3, ocr_4, ocr_5, ocr_6, whisper_transcript, whisper_language, whisper_translated FROM tiktok_videos WHERE author_username = ? AND video_id = ?", (str(author_username), str(video_id)))
+    processed = c.fetchone()
+    if not processed:
+        return False
+    logger.debug(f'Video already processed: {author_username} - {video_id}')
+    frames, ocr_1, ocr_2, ocr_3, ocr_4, ocr_5, ocr_6, whisper_transcript, whisper_language, whisper_translated = processed
+    df.at[index, 'frame_files'] = str(frames)
+    df.at[index, 'ocr_1'] = str(ocr_1)
+    df.at[index, 'ocr_2'] = str(ocr_2)
+    df.at[index, 'ocr_3'] = str(ocr_3)
+    df.at[index, 'ocr_4'] = str(ocr_4)
+    df.at[index, 'ocr_5'] = str(ocr_5)
+    df.at[index, 'ocr_6'] = str(ocr_6)
+    df.at[index, 'whisper_transcript'] = str(whisper_transcript)
+    df.at[index, 'whisper_language'] = str(whisper_language)
+    df.at[index, 'whisper_translated'] = str(whisper_translated)
+    return True
+
+# Dataframe columns filled by preprocessing
+saved_columns = ['frame_files', 'ocr_1', 'ocr_2', 'ocr_3', 'ocr_4', 'ocr_5', 'ocr_6', 'whisper_transcript', 'whisper_language', 'whisper_translated']
+
+def save_video(df, index, author_username, video_id, frame_files, ocr_texts, transcript):
+    """Insert a preprocessed video into the database and the dataframe."""
+    (ocr_1, ocr_2, ocr_3, ocr_4, ocr_5, ocr_6) = ocr_texts
+    (whisper_transcript, whisper_language, whisper_translated) = transcript
+    # Insert into database
+    c.execute("INSERT INTO tiktok_videos (author_username, video_id, frames, ocr_1, ocr_2, ocr_3, ocr_4, ocr_5, ocr_6, whisper_transcript, whisper_language, whisper_translated) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", (author_username, video_id, str(frame_files), str(ocr_1), str(ocr_2), str(ocr_3), str(ocr_4), str(ocr_5), str(ocr_6), str(whisper_transcript), str(whisper_language), str(whisper_translated)))
+    conn.commit()
+    # Frame files to string
+    frame_files = ','.join(frame_files)
+    # Add to dataframe
+    df.at[index, 'frame_files'] = str(frame_files)
+    df.at[index, 'ocr_1'] = str(ocr_1)
+    df.at[index, 'ocr_2'] = str(ocr_2)
+    df.at[index, 'ocr_3'] = str(ocr_3)
+    df.at[index, 'ocr_4'] = str(ocr_4)
+    df.at[index, 'ocr_5'] = str(ocr_5)
+    df.at[index, 'ocr_6'] = str(ocr_6)
+    df.at[index, 'whisper_transcript'] = str(whisper_transcript)
+    df.at[index, 'whisper_language'] = str(whisper_language)
+    df.at[index, 'whisper_translated'] = str(whisper_translated)
+
+
+def load_videos(language):
+    """Load scraped TikTok videos for a specific language."""
     # We have exported the scraped TikTok data from MariaDB to a CSV file
     df = pd.read_csv(f'./csv/tiktok_videos.csv')
     df = df.dropna(subset=['whisperResult'])
@@ -107,6 +221,11 @@ def analyze_videos(language):
     df['whisper_translated'] = ''
     # Take only rows where the language is the same
     df = df[df['language'] == language]
+    return df
+
+def analyze_videos(language):
+    """Preprocess TikTok videos for a specific language."""
+    df = load_videos(language)
     for (index, row) in df.iterrows():
         author_username = row['authorUniqueId']
         video_id = row['videoId']
@@ -114,86 +233,162 @@ def analyze_videos(language):
         # CSC Allas video path
         video_path = f'./Allas/Scraper/TikTok/Videos/{scrapedCountry}/{author_username}/{video_id}.mp4'
         # Check if exists in database
-        c.execute("SELECT * FROM tiktok_videos WHERE author_username = ? AND video_id = ?", (str(author_username), str(video_id)))
-        if c.fetchone():
-            logger.debug(f'Video already processed: {author_username} - {video_id}')
-            # Get the the video from the database
-            c.execute("SELECT frames, ocr_1, ocr_2, ocr_3, ocr_4, ocr_5, ocr_6, whisper_transcript, whisper_language, whisper_translated FROM tiktok_videos WHERE author_username = ? AND video_id = ?", (str(author_username), str(video_id)))
-            frames, ocr_1, ocr_2, ocr_3, ocr_4, ocr_5, ocr_6, whisper_transcript, whisper_language, whisper_translated = c.fetchone()
-            df.at[index, 'frame_files'] = str(frames)
-            df.at[index, 'ocr_1'] = str(ocr_1)
-            df.at[index, 'ocr_2'] = str(ocr_2)
-            df.at[index, 'ocr_3'] = str(ocr_3)
-            df.at[index, 'ocr_4'] = str(ocr_4)
-            df.at[index, 'ocr_5'] = str(ocr_5)
-            df.at[index, 'ocr_6'] = str(ocr_6)
-            df.at[index, 'whisper_transcript'] = str(whisper_transcript)
-            df.at[index, 'whisper_language'] = str(whisper_language)
-            df.at[index, 'whisper_translated'] = str(whisper_translated)
-        else:
+        if not load_processed(df, index, author_username, video_id):
             # Check if video exists
             if not os.path.exists(video_path):
                 logger.error(f'Video does not exist: {author_username} - {video_id}')
             else:
                 try:
                     frame_files = get_keyframes(video_path, video_id, author_username)
-                    # Split frame_files
-                    frame_number = 1
-                    ocr_1 = ''
-                    ocr_2 = ''
-                    ocr_3 = ''
-                    ocr_4 = ''
-                    ocr_5 = ''
-                    ocr_6 = ''
-                    for i, frame_file in enumerate(frame_files):
-                        # OCR
-                        results = reader.readtext(frame_file)
-                        ocr_text = ''
-                        for result in results:
-                            ocr_text = ocr_text + result[1]
-                            ocr_text = ocr_text + '\n'
-                        if frame_number == 1:
-                            ocr_1 = str(ocr_text)
-                        elif frame_number == 2:
-                            ocr_2 = str(ocr_text)
-                        elif frame_number == 3:
-                            ocr_3 = str(ocr_text)
-                        elif frame_number == 4:
-                            ocr_4 = str(ocr_text)
-                        elif frame_number == 5:
-                            ocr_5 = str(ocr_text)
-                        elif frame_number == 6:
-                            ocr_6 = str(ocr_text)
-                        frame_number = frame_number + 1
+                    ocr_texts = get_ocr(frame_files)
                     # Get the whisper transcript
-                    (whisper_transcript, whisper_language, whisper_translated) = get_transcript(video_id, author_username, scrapedCountry)
-                    # Insert into database
-                    c.execute("INSERT INTO tiktok_videos (author_username, video_id, frames, ocr_1, ocr_2, ocr_3, ocr_4, ocr_5, ocr_6, whisper_transcript, whisper_language, whisper_translated) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", (author_username, video_id, str(frame_files), str(ocr_1), str(ocr_2), str(ocr_3), str(ocr_4), str(ocr_5), str(ocr_6), str(whisper_transcript), str(whisper_language), str(whisper_translated)))
-                    conn.commit()
-                    # Frame files to string
-                    frame_files = ','.join(frame_files)
-                    # Add to dataframe
-                    df.at[index, 'frame_files'] = str(frame_files)
-                    df.at[index, 'ocr_1'] = str(ocr_1)
-                    df.at[index, 'ocr_2'] = str(ocr_2)
-                    df.at[index, 'ocr_3'] = str(ocr_3)
-                    df.at[index, 'ocr_4'] = str(ocr_4)
-                    df.at[index, 'ocr_5'] = str(ocr_5)
-                    df.at[index, 'ocr_6'] = str(ocr_6)
-                    df.at[index, 'whisper_transcript'] = str(whisper_transcript)
-                    df.at[index, 'whisper_language'] = str(whisper_language)
-                    df.at[index, 'whisper_translated'] = str(whisper_translated)
+                    transcript = get_transcript(video_id, author_username, scrapedCountry)
+                    save_video(df, index, author_username, video_id, frame_files, ocr_texts, transcript)
                 except Exception as e:
                     logger.error(f'Error processing video: {e}')
     filename = f'./csv/tiktok_{language}.csv'
     df.to_csv(filename, index=False)
 
-# All EP2024 TikTok languages for preprocessing
-languages = ['fi', 'sv', 'pl', 'pt', 'de', 'es', 'hu', 'hr', 'fr', 'en']
-for language in languages:
-    analyze_videos(language)
+def get_frame_result(future):
+    """Get the result of an OCR job, failing if an OCR worker has died."""
+    try:
+        return future.result()
+    except BrokenProcessPool as e:
+        raise RuntimeError(f'OCR worker exited: {e}')
+
+def get_whisper_result(result_queue, whisper_process):
+    """Wait for the next Whisper result, failing if the Whisper worker has died."""
+    while True:
+        try:
+            return result_queue.get(timeout=60)
+        except queue.Empty:
+            if not whisper_process.is_alive():
+                raise RuntimeError(f'Whisper worker exited with code {whisper_process.exitcode}')
+
+def analyze_videos_parallel(language, pool, audio_queue, result_queue, whisper_process):
+    """Preprocess TikTok videos for a specific language with worker processes."""
+    df = load_videos(language)
+    # Videos waiting for OCR and Whisper results, with their dataframe indices
+    pending = {}
+    frame_jobs = []
+    for (index, row) in df.iterrows():
+        author_username = row['authorUniqueId']
+        video_id = row['videoId']
+        scrapedCountry = row['scrapedCountry']
+        # CSC Allas video path
+        video_path = f'./Allas/Scraper/TikTok/Videos/{scrapedCountry}/{author_username}/{video_id}.mp4'
+        # Check if exists in database
+        if load_processed(df, index, author_username, video_id):
+            continue
+        # Same video may be listed more than once, process it only once
+        key = (str(author_username), str(video_id))
+        if key in pending:
+            pending[key].append(index)
+            continue
+        # Check if video exists
+        if not os.path.exists(video_path):
+            logger.error(f'Video does not exist: {author_username} - {video_id}')
+            continue
+        pending[key] = [index]
+        frame_jobs.append((video_path, video_id, author_username))
+        audio_queue.put((video_id, author_username, scrapedCountry))
+    frame_results = {}
+    transcripts = {}
+    # This process is the only database writer, save each video when both results are in
+    futures = [pool.submit(preprocess_frames, frame_job) for frame_job in frame_jobs]
+    for future in as_completed(futures):
+        (author_username, video_id, frame_files, ocr_texts) = get_frame_result(future)
+        frame_results[(author_username, video_id)] = (frame_files, ocr_texts)
+        save_ready(df, pending, frame_results, transcripts, (author_username, video_id))
+        while True:
+            try:
+                (whisper_author, whisper_video, transcript) = result_queue.get_nowait()
+            except queue.Empty:
+                break
+            transcripts[(whisper_author, whisper_video)] = transcript
+            save_ready(df, pending, frame_results, transcripts, (whisper_author, whisper_video))
+    # Wait for the rest of the transcripts
+    while pending:
+        (whisper_author, whisper_video, transcript) = get_whisper_result(result_queue, whisper_process)
+        transcripts[(whisper_author, whisper_video)] = transcript
+        save_ready(df, pending, frame_results, transcripts, (whisper_author, whisper_video))
+    filename = f'./csv/tiktok_{language}.csv'
+    df.to_csv(filename, index=False)
+
+def save_ready(df, pending, frame_results, transcripts, key):
+    """Save a pending video if it has both OCR and Whisper results."""
+    if key not in frame_results or key not in transcripts:
+        return
+    indices = pending.pop(key)
+    (frame_files, ocr_texts) = frame_results.pop(key)
+    transcript = transcripts.pop(key)
+    (author_username, video_id) = key
+    # Keyframe or OCR errors were logged by the worker
+    if frame_files is None:
+        return
+    try:
+        save_video(df, indices[0], author_username, video_id, frame_files, ocr_texts, transcript)
+        # Copy the results to other rows of the same video
+        for index in indices[1:]:
+            df.loc[index, saved_columns] = df.loc[indices[0], saved_columns]
+    except Exception as e:
+        logger.error(f'Error processing video: {e}')
 
+if __name__ == '__main__':
+    # Sqlite3 database connection
+    conn = sqlite3.connect('./database/preprocess.db')
+    c = conn.cursor()
+    # Create table if not exists
+    c.execute('''CREATE TABLE IF NOT EXISTS tiktok_videos
+                    (author_username text, 
+                    video_id text,
+                    frames text,
+                    ocr_1 text,
+                    ocr_2 text,
+                    ocr_3 text,
+                    ocr_4 text,
+                    ocr_5 text,
+                    ocr_6 text,
+                    whisper_transcript text,
+                    whisper_language text,
+                    whisper_translated text)''')
+    conn.commit()
 
-c.close()
-conn.close()
+    # All EP2024 TikTok languages for preprocessing
+    languages = ['fi', 'sv', 'pl', 'pt', 'de', 'es', 'hu', 'hr', 'fr', 'en']
+    if ocr_workers > 0:
+        # Spawned workers do not inherit loaded models or threads from this process
+        context = multiprocessing.get_context('spawn')
+        audio_queue = context.Queue()
+        result_queue = context.Queue()
+        # Thread limits in the environment apply when the worker imports torch
+        set_thread_env(whisper_threads)
+        whisper_process = context.Process(target=whisper_worker, args=(audio_queue, result_queue, whisper_threads), name='Whisper')
+        whisper_process.start()
+        try:
+            set_thread_env(ocr_threads)
+            pool = ProcessPoolExecutor(ocr_workers, mp_context=context, initializer=init_ocr_worker, initargs=(ocr_threads,))
+            try:
+                for language in languages:
+                    analyze_videos_parallel(language, pool, audio_queue, result_queue, whisper_process)
+            finally:
+                # Queued OCR jobs are not needed if the run failed
+                pool.shutdown(cancel_futures=True)
+            audio_queue.put(None)
+            whisper_process.join()
+        finally:
+            # Stop the Whisper worker if the run failed or was interrupted
+            if whisper_process.is_alive():
+                whisper_process.terminate()
+                whisper_process.join()
+            # Unread audio jobs must not keep this process from exiting
+            audio_queue.cancel_join_thread()
+    else:
+        # Load the models before processing, a load failure stops the run
+        get_reader()
+        get_model()
+        for language in languages:
+            analyze_videos(language)
 
+    c.close()
+    conn.close()
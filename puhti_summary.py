@@ -8,7 +8,9 @@ import cv2
 import ollama
 import base64
 import sqlite3
-import time
+import string
+import hashlib
+from dateutil import tz
 from logging.handlers import RotatingFileHandler
 logger = logging.getLogger(__name__)
 logging.basicConfig(handlers=[RotatingFileHandler('./logs/summary.log', encoding='utf-8', maxBytes=1000000, backupCount=5)], level=logging.DEBUG)
@@ -21,12 +23,16 @@ c = conn.cursor()
 c.execute('''CREATE TABLE IF NOT EXISTS tiktok_videos
                 (author_username text, 
                 video_id text,
-                summary_analysis text)''')
+                summary_analysis text,
+                prompt_hash text)''')
+# Add prompt hash to databases created before prompts were hashed
+columns = [column[1] for column in c.execute("PRAGMA table_info(tiktok_videos)")]
+if 'prompt_hash' not in columns:
+    c.execute("ALTER TABLE tiktok_videos ADD COLUMN prompt_hash text")
 conn.commit()
 
-def get_llama_summary_user_prompt(metadata, transcript, frame_analysis):
-    """Construct the user prompt for the Llama model."""
-    user_message = f'''### **User Prompt**:
+# Prompt templates, filled column-wise for all videos at once
+summary_user_prompt = '''### **User Prompt**:
 
     **Data for Analysis**:
 
@@ -48,7 +54,42 @@ def get_llama_summary_user_prompt(metadata, transcript, frame_analysis):
     ### **Task**:
     Utilize the provided data (**frame analysis**, **metadata** and **transcript**) to conduct a comprehensive political analysis of the TikTok video.
     '''
-    return user_message
+
+summary_metadata = '''- Author name: {author_name}        
+        - Author username: {author_username}        
+        - Author signature: {author_signature}        
+        - Description: {video_description}      
+        - Timestamp: {video_timestamp}      
+        - Duration: {video_duration}        
+        - Diggs: {video_diggcount}        
+        - Shares: {video_sharecount}        
+        - Comments: {video_commentcount}        
+        - Plays: {video_playcount}    
+        - Video URL: {video_url}        
+        - Author URL: {author_url} 
+        - Hashtags: {hashtags}
+        '''
+
+# The first frame is always included, later frames only if they were analyzed
+first_frame_analysis = '''
+
+        {frame_analysis}
+
+        ### OCR results for frame {frame_number} at {seconds} seconds:
+        
+        {ocr}
+            
+        '''
+
+next_frame_analysis = '''
+            
+            {frame_analysis}
+                        
+            ### OCR results for frame {frame_number} at {seconds} seconds:
+            
+            {ocr}
+            
+            '''
 
 def get_llama_summary_system_prompt():
     """Construct the system prompt for the Llama model."""
@@ -144,161 +185,118 @@ def get_llama_summary_response(system_prompt, user_prompt):
     return llama_response
 
 
+def format_columns(template, columns):
+    """Fill a template column-wise from a dict of string Series or strings."""
+    result = None
+    for (literal, field, format_spec, conversion) in string.Formatter().parse(template):
+        part = literal
+        if field is not None:
+            part = part + columns[field]
+        result = part if result is None else result + part
+    return result
+
+def prepare_prompts(df):
+    """Prepare metadata, user prompts and prompt hashes for all videos at once."""
+    author_username = df['authorUniqueId'].map(str)
+    video_id = df['videoId'].map(str)
+    video_description = df['videoDescription'].map(str)
+    # Timestamps in local time like time.localtime
+    video_timestamp = pd.to_datetime(df['videoCreated'], unit='s', utc=True).dt.tz_convert(tz.tzlocal())
+    video_timestamp = video_timestamp.dt.strftime('%Y-%m-%d %H:%M:%S').fillna('')
+    # Hashtags are words starting with #
+    hashtags = video_description.str.findall(r'(?<!\S)#\S*').str.join(', ')
+    df['metadata'] = format_columns(summary_metadata, {
+        'author_name': df['authorNickname'].map(str),
+        'author_username': author_username,
+        'author_signature': df['authorSignature'].map(str),
+        'video_description': video_description,
+        'video_timestamp': video_timestamp,
+        'video_duration': df['videoDuration'].map(str),
+        'video_diggcount': df['videoDiggCount'].map(str),
+        'video_sharecount': df['videoShareCount'].map(str),
+        'video_commentcount': df['videoCommentCount'].map(str),
+        'video_playcount': df['videoPlayCount'].map(str),
+        'video_url': 'https://www.tiktok.com/@' + author_username + '/video/' + video_id,
+        'author_url': 'https://www.tiktok.com/@' + author_username,
+        'hashtags': hashtags})
+    # Create frame analysis from 1-6 frames and their OCR results
+    frame_analysis = ''
+    for frame_number in range(1, 7):
+        # Empty cells are read from csv as NaN
+        frame_response = df[f'frame_analysis_{frame_number}'].fillna('').map(str)
+        ocr = df[f'ocr_{frame_number}'].fillna('').map(str)
+        template = first_frame_analysis if frame_number == 1 else next_frame_analysis
+        frame_block = format_columns(template, {
+            'frame_analysis': frame_response,
+            'ocr': ocr,
+            'frame_number': str(frame_number),
+            'seconds': str((frame_number - 1) * 30)})
+        # If frame analysis exists and not empty string
+        if frame_number > 1:
+            frame_block = frame_block.where(frame_response != '', '')
+        frame_analysis = frame_analysis + frame_block
+    df['user_prompt'] = format_columns(summary_user_prompt, {
+        'metadata': df['metadata'],
+        'transcript': df['whisperResult'].map(str),
+        'frame_analysis': frame_analysis})
+    # Hash the complete prompt, a stored summary is only reused for the same prompt
+    system_prompt = get_llama_summary_system_prompt()
+    df['prompt_hash'] = [hashlib.sha256((system_prompt + user_prompt).encode('utf-8')).hexdigest() for user_prompt in df['user_prompt']]
+    return df
+
+def get_summaries(keys):
+    """Get stored summary analyses and prompt hashes for (author_username, video_id) keys."""
+    summaries = {}
+    video_ids = sorted(set(video_id for (author_username, video_id) in keys))
+    # Query in chunks to stay within the SQLite variable limit
+    for start in range(0, len(video_ids), 500):
+        chunk = video_ids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        c.execute(f"SELECT author_username, video_id, summary_analysis, prompt_hash FROM tiktok_videos WHERE video_id IN ({placeholders})", chunk)
+        for (author_username, video_id, summary_analysis, prompt_hash) in c.fetchall():
+            summaries[(author_username, video_id)] = (summary_analysis, prompt_hash)
+    return summaries
+
 def analyze_videos(language):
     """Analyze TikTok videos for a specific language."""
     # Read csv
     filename = f'./csv/tiktok_{language}.csv'
     df = pd.read_csv(filename)
     df = df.dropna(subset=['whisperResult'])
-    df['summary_analysis'] = ''
-    # Take only rows where language is fi
-    for (index, row) in df.iterrows():
-        author_username = row['authorUniqueId']
-        video_id = row['videoId']
-        logger.debug(f'Analyzing video {row["videoId"]}')
-        video_timestamp = row['videoCreated']
-        video_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(video_timestamp))
-        video_duration = row['videoDuration']
-        video_diggcount = row['videoDiggCount']
-        video_sharecount = row['videoShareCount']
-        video_commentcount = row['videoCommentCount']
-        video_playcount = row['videoPlayCount']
-        video_description = row['videoDescription']
-        author_name = row['authorNickname']
-        author_signature = row['authorSignature']
-        video_url = f'https://www.tiktok.com/@{author_username}/video/{video_id}'
-        author_url = f'https://www.tiktok.com/@{author_username}'
-        hashtags = ''
-        video_description = str(video_description)
+    # Take only rows where language is the same
+    df = df[df['language'] == language].copy()
+    df = prepare_prompts(df)
+    system_prompt = get_llama_summary_system_prompt()
+    keys = list(zip(df['authorUniqueId'].map(str), df['videoId'].map(str)))
+    # Get stored summaries for this language from the database in bulk
+    summaries = get_summaries(keys)
+    # Reuse a stored summary only if it was made from the same prompt, changed
+    # inputs and summaries stored without a prompt hash are analyzed again
+    cached = [key in summaries and summaries[key][1] == prompt_hash for (key, prompt_hash) in zip(keys, df['prompt_hash'])]
+    df['summary_analysis'] = [str(summaries[key][0]) if is_cached else '' for (key, is_cached) in zip(keys, cached)]
+    todo = df[[not is_cached for is_cached in cached]]
+    logger.debug(f'Videos already processed: {len(df) - len(todo)}, videos to analyze: {len(todo)}')
+    for (index, key, user_prompt, prompt_hash) in zip(todo.index, zip(todo['authorUniqueId'].map(str), todo['videoId'].map(str)), todo['user_prompt'], todo['prompt_hash']):
+        (author_username, video_id) = key
+        # Same video may be listed more than once
+        if key in summaries and summaries[key][1] == prompt_hash:
+            df.at[index, 'summary_analysis'] = str(summaries[key][0])
+            continue
         try:
-            hashtags = [tag.strip() for tag in video_description.split() if tag.startswith('#')]
-            hashtags = ', '.join(hashtags)
-        except Exception as e:
-            logger.error(f'Error extracting hashtags: {e}')
-            hashtags = ''
-        metadata = f'''- Author name: {author_name}        
-        - Author username: {author_username}        
-        - Author signature: {author_signature}        
-        - Description: {video_description}      
-        - Timestamp: {video_timestamp}      
-        - Duration: {video_duration}        
-        - Diggs: {video_diggcount}        
-        - Shares: {video_sharecount}        
-        - Comments: {video_commentcount}        
-        - Plays: {video_playcount}    
-        - Video URL: {video_url}        
-        - Author URL: {author_url} 
-        - Hashtags: {hashtags}
-        '''
-        logger.debug(f'Metadata: {metadata}')
-        transcript = row['whisperResult']
-        logger.debug(f'Transcript: {transcript}')
-        # Add metadata to row
-        df.at[index, 'metadata'] = str(metadata)
-        # Create frame analysis
-        frame_analysis_1 = row['frame_analysis_1']
-        frame_analysis_2 = row['frame_analysis_2']
-        frame_analysis_3 = row['frame_analysis_3']
-        frame_analysis_4 = row['frame_analysis_4']
-        frame_analysis_5 = row['frame_analysis_5']
-        frame_analysis_6 = row['frame_analysis_6']
-        ocr_1 = row['ocr_1']
-        ocr_2 = row['ocr_2']
-        ocr_3 = row['ocr_3']
-        ocr_4 = row['ocr_4']
-        ocr_5 = row['ocr_5']
-        ocr_6 = row['ocr_6']
-        frame_analysis = f'''
-
-        {frame_analysis_1}
-
-        ### OCR results for frame 1 at 0 seconds:
-        
-        {ocr_1}
-            
-        '''
-            
-        # If frame_analysis_2 exists and not empty string
-        if frame_analysis_2:
-            frame_analysis = frame_analysis + f'''
-            
-            {frame_analysis_2}
-                        
-            ### OCR results for frame 2 at 30 seconds:
-            
-            {ocr_2}
-            
-            '''
-        
-        # If frame_analysis_3 exists and not empty string
-        if frame_analysis_3:
-            frame_analysis = frame_analysis + f'''
-            
-            {frame_analysis_3}
-                        
-            ### OCR results for frame 3 at 60 seconds:
-            
-            {ocr_3}
-            
-            '''
-            
-        # If frame_analysis_4 exists and not empty string
-        if frame_analysis_4:
-            frame_analysis = frame_analysis + f'''
-            
-            {frame_analysis_4}
-                        
-            ### OCR results for frame 4 at 90 seconds:
-            
-            {ocr_4}
-            
-            '''
-            
-        # If frame_analysis_5 exists and not empty string
-        if frame_analysis_5:
-            frame_analysis = frame_analysis + f'''
-            
-            {frame_analysis_5}
-                        
-            ### OCR results for frame 5 at 120 seconds:
-            
-            {ocr_5}
-            
-            '''
-            
-        # If frame_analysis_6 exists and not empty string
-        if frame_analysis_6:
-            frame_analysis = frame_analysis + f'''
-            
-            {frame_analysis_6}
-                        
-            ### OCR results for frame 6 at 150 seconds:
-            
-            {ocr_6}
-            
-            '''
-        
-        logger.debug(f'Frame analysis: {frame_analysis}')
-        
-        # Check if exists in database
-        c.execute("SELECT * FROM tiktok_videos WHERE author_username = ? AND video_id = ?", (str(author_username), str(video_id)))
-        if c.fetchone():
-            logger.debug(f'Video already processed: {author_username} - {video_id}')
-            # Get the frame analysis from the database
-            c.execute("SELECT summary_analysis FROM tiktok_videos WHERE author_username = ? AND video_id = ?", (str(author_username), str(video_id)))
-            summary_analysis = c.fetchone()[0]
+            logger.debug(f'Analyzing video {video_id}')
+            summary_analysis = get_llama_summary_response(system_prompt, user_prompt)
+            if key in summaries:
+                c.execute("UPDATE tiktok_videos SET summary_analysis = ?, prompt_hash = ? WHERE author_username = ? AND video_id = ?", (str(summary_analysis), prompt_hash, author_username, video_id))
+            else:
+                c.execute("INSERT INTO tiktok_videos (author_username, video_id, summary_analysis, prompt_hash) VALUES (?, ?, ?, ?)",(author_username, video_id, str(summary_analysis), prompt_hash))
+            conn.commit()
+            summaries[key] = (summary_analysis, prompt_hash)
             df.at[index, 'summary_analysis'] = str(summary_analysis)
-        else:
-            try:
-                user_prompt = get_llama_summary_user_prompt(metadata, transcript, frame_analysis)
-                system_prompt = get_llama_summary_system_prompt()
-                summary_analysis = get_llama_summary_response(system_prompt, user_prompt)
-                c.execute("INSERT INTO tiktok_videos (author_username, video_id, summary_analysis) VALUES (?, ?, ?)",(str(author_username), str(video_id), str(summary_analysis)))
-                conn.commit()
-                df.at[index, 'summary_analysis'] = str(summary_analysis)
-                logger.debug(f'Summary analysis: {summary_analysis}')
-            except Exception as e:
-                logger.error(f'Error processing video: {e}')
+            logger.debug(f'Summary analysis: {summary_analysis}')
+        except Exception as e:
+            logger.error(f'Error processing video: {e}')
+    # Prompts and their hashes are only needed for the analysis
+    df = df.drop(columns=['user_prompt', 'prompt_hash'])
     df.to_csv(f'./csv/tiktok_{language}.csv', index=False)
 
 # Loop through each EP2024 TikTok language and analyze videos